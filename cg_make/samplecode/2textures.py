@@ -1,6 +1,8 @@
+import os
 import pyglet
 from pyglet.gl import *
-from PIL import Image
+
+DATA_DIRPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 
 def resize_texture(texture, new_width, new_height):
     # Get the pixel data from the original texture
@@ -23,24 +25,6 @@ def resize_texture(texture, new_width, new_height):
 # Window dimensions
 WIDTH, HEIGHT = 1200, 1000
 
-tex2 = Image.open('data/wolf.png')
-width, height = 100, 100
-tex2_resized = tex2.resize((width, height))
-# Load textures
-texture1 = pyglet.image.load('data/back.JPG').get_texture()
-texture2 = pyglet.image.load('data/wolf.png').get_texture()
-
-# Resize texture
-# width = 10  # Desired width
-# height = 20  # Desired height
-# texture2 = texture2.get_region(0, 0, width, height)
-
-# Resize texture2 to new width and height
-new_width = 200
-new_height = 200
-texture2 = resize_texture(texture2, new_width, new_height)
-print(type(texture2))
-
 # Create vertex list for quad
 vertex_list = pyglet.graphics.vertex_list(4,
     ('v2f', [0, 0, WIDTH, 0, WIDTH, HEIGHT, 0, HEIGHT]),
@@ -56,6 +40,20 @@ texture2_y = 100
 # Create window
 window = pyglet.window.Window(WIDTH, HEIGHT, resizable=True)
 
+# Load textures (after the window so that it appears as early as possible)
+texture1 = pyglet.image.load(os.path.join(DATA_DIRPATH, 'back.JPG')).get_texture()
+texture2 = pyglet.image.load(os.path.join(DATA_DIRPATH, 'wolf.png')).get_texture()
+
+# Resize texture
+# width = 10  # Desired width
+# height = 20  # Desired height
+# texture2 = texture2.get_region(0, 0, width, height)
+
+# Resize texture2 to new width and height
+new_width = 200
+new_height = 200
+texture2 = resize_texture(texture2, new_width, new_height)
+
 @window.event
 def on_draw():
     window.clear()
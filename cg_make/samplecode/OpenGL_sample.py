@@ -13,6 +13,7 @@ Keyboard:
     [a]     Toggle axis, frustrum, grid
     [b]     Toggle chessbord
     [g]     Toggle drawing grid floor
+    [o]     Toggle shadow compensation overlay
     [p]     Pause
     [r]     Reset View
     [s]     Save PNG (./out.png)
@@ -22,18 +23,35 @@ Keyboard:
     [↓]     zoom by increasing zNear (by delta_zNear)
     [q/ESC] Quit
 
+Options:
+--------
+    --profile-startup   import / 初期化の所要時間の内訳を表示する
+    --shadow-video PATH         影補償に使うカメラ映像（動画ファイル）
+    --shadow-reference PATH     遮蔽がないときのカメラ画像（省略時は最初のフレーム）
+    --shadow-homography PATH    カメラ -> プロジェクタのホモグラフィ（3x3, .npy）
+    --radiometric-model PATH    輝度補償モデル（radiometric.py で作成）でボード画像を補正する
+    --calibrate-radiometric DIR flat-field を投影して撮影画像を DIR に保存し、モデルを作る
+    --camera SRC                キャリブレーションに使うカメラ（番号または動画ファイル）
+    --levels N                  flat-field のレベル数
+    --radiometric-homography PATH  撮影画像 -> ボード画像のホモグラフィ（3x3, .npy）
+
 """
 
 import os
 import math
-import numpy as np
-import cv2
+import ctypes
+from concurrent.futures import ThreadPoolExecutor
 
-from PIL import Image
-import pyglet
-import pyglet.gl as gl
+from startup import PROFILER, lazy_import, add_profile_option
+import shadow_removal
+import radiometric
 
-import ctypes
+# 重いモジュールは初回アクセス時に読み込む
+np = lazy_import("numpy")
+cv2 = lazy_import("cv2")
+Image = lazy_import("PIL.Image")
+pyglet = lazy_import("pyglet")
+gl = lazy_import("pyglet.gl")
 
 #===============================
 # 定数
@@ -42,9 +60,10 @@ import ctypes
 TARGET_SCREEN_ID = 0     # プロジェクタのスクリーンID
 
 DATA_DIRNAME = "data"
-DATA_DIRPATH = os.path.join(os.path.dirname(__file__), DATA_DIRNAME)
-if not os.path.exists(DATA_DIRPATH):
-    os.makedirs(DATA_DIRPATH)
+DATA_DIRPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), DATA_DIRNAME)
+
+BOARD_IMAGE_FILENAME = "back.JPG"  # ボードに貼る画像
+WOLF_IMAGE_FILENAME = "wolf.png"   # 重ねて表示する画像
 
 CHESS_HNUM = 7       # 水平方向個数
 CHESS_VNUM = 10      # 垂直方向個数
@@ -57,6 +76,9 @@ BOARD_X = 0.         # chessboard の3次元位置X座標 [m]（右手系）
 BOARD_Y = 0.         # chessboard の3次元位置Y座標 [m]（右手系）
 BOARD_Z = -3.0       # chessboard の3次元位置Z座標 [m]（右手系）[see]
 
+CALIB_SETTLE_TIME = 1.0   # flat-field を切り替えてから撮影するまでの時間 [s]
+CALIB_FLUSH_FRAMES = 5    # 撮影前に捨てるカメラのフレーム数（バッファに残った古い画像）
+
 
 # OpenGL の射影のパラメータ
 class Params:
@@ -81,6 +103,18 @@ cam_w, cam_h  = 0, 0 # 画面解像度
 # ボードのテクスチャ
 board_texture = None
 chessboard_data = None
+chessboard_image = None
+wolf_image = None
+texture_ids = None
+
+# 影補償
+shadow_pipeline = None   # shadow_removal.ShadowPipeline
+shadow_overlay = None    # 最後にテクスチャへ転送したオーバーレイ
+
+# 輝度補償
+board_content = None       # 補正前のボード画像
+radiometric_model = None   # radiometric.RadiometricModel
+calibration = None         # flat-field キャリブレーション中の状態
 
 # ボードの位置
 board_vertices = ((BOARD_X - BOARD_WIDTH / 2, BOARD_Y + BOARD_HEIGHT, BOARD_Z),
@@ -109,6 +143,7 @@ class AppState:
         self.draw_axes = False
         self.draw_grid = False
         self.draw_board = True
+        self.draw_shadow = True
         self.half_fov = False                  # プロジェクタの画角の変数
 
     def reset(self):
@@ -185,20 +220,42 @@ def make_chessboard(num_h, num_v, margin, block_size):
 #     gl.glBindTexture(gl.GL_TEXTURE_2D, texture_ids[0])
 #     gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGB, tw, th, 0, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, chessboard_image.tobytes())
 
-def load_png():
+#-------------------------------
+# 画像の読み込み
+#-------------------------------
+def decode_image(filename, mode):
+    """decode an image in DATA_DIRPATH (safe to call from worker threads)"""
+    filepath = os.path.join(DATA_DIRPATH, filename)
+    image = Image.open(filepath)
+    # convert() でデコードまで済ませておく（GL への転送はメインスレッドで行う）
+    return image.convert(mode)
+
+def start_loading_assets(executor):
+    """start decoding the images in parallel, before the window is created"""
+    return {
+        "board": executor.submit(decode_image, BOARD_IMAGE_FILENAME, "RGB"),
+        "wolf": executor.submit(decode_image, WOLF_IMAGE_FILENAME, "RGBA"),
+    }
+
+def load_png(image, correct=True):
     global chessboard_image, texture_ids
 
-    chessboard = make_chessboard(CHESS_HNUM, CHESS_VNUM, CHESS_MARGIN, CHESS_BLOCKSIZE)
-
-    filepath = os.path.join(DATA_DIRPATH, 'back.jpg')
-    # cv2.imwrite(filepath, chessboard)
-    chessboard_image = Image.open(filepath)
+    # 輝度補償モデルがあればテクスチャに転送する前に補正する
+    if correct and radiometric_model is not None:
+        image = Image.fromarray(radiometric_model.apply(np.asarray(image)))
+    chessboard_image = image
 
     tw, th = chessboard_image.width, chessboard_image.height
-    print(type(tw), tw)
     gl.glBindTexture(gl.GL_TEXTURE_2D, texture_ids[0])
     gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGB, tw, th, 0, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, chessboard_image.tobytes())
 
+def load_wolf(image):
+    global wolf_image
+
+    w, h = image.width, image.height
+    # PIL は上から下、pyglet は下から上の行順なので pitch を負にする
+    wolf_image = pyglet.image.ImageData(w, h, "RGBA", image.tobytes(), pitch=-w * 4)
+
 
 #-------------------------------
 # 描画関数
@@ -295,10 +352,156 @@ def board_test():
     gl.glVertex3f(*board_vertices[3])
     gl.glEnd()
     gl.glPopMatrix()
-    wolf_image.blit(1000, 1000)
+    if calibration is None:
+        wolf_image.blit(1000, 1000)
 
     gl.glDisable(gl.GL_TEXTURE_2D)
 
+# 影補償オーバーレイ（プロジェクタ座標のアルファマスク）を黒としてボードの上に重ねる
+def shadow_overlay_pass():
+    global shadow_overlay
+
+    # ソースが終わったら None になり、オーバーレイは消える
+    overlay = shadow_pipeline.latest()
+    if overlay is None:
+        return
+
+    gl.glEnable(gl.GL_TEXTURE_2D)
+    gl.glBindTexture(gl.GL_TEXTURE_2D, texture_ids[1])
+    if overlay is not shadow_overlay:
+        h, w = overlay.shape[:2]
+        pixels = overlay.ctypes.data_as(ctypes.POINTER(gl.GLubyte))
+        # 1チャンネルなので行の長さが4の倍数とは限らない
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        if shadow_overlay is None or shadow_overlay.shape != overlay.shape:
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+            gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_ALPHA, w, h, 0, gl.GL_ALPHA, gl.GL_UNSIGNED_BYTE, pixels)
+        else:
+            gl.glTexSubImage2D(gl.GL_TEXTURE_2D, 0, 0, 0, w, h, gl.GL_ALPHA, gl.GL_UNSIGNED_BYTE, pixels)
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 4)
+        shadow_overlay = overlay
+    # 色は glColor（黒）、アルファはテクスチャから取る
+    gl.glTexEnvi(gl.GL_TEXTURE_ENV, gl.GL_TEXTURE_ENV_MODE, gl.GL_MODULATE)
+    gl.glColor4f(0, 0, 0, 1)
+
+    gl.glDisable(gl.GL_DEPTH_TEST)
+    gl.glEnable(gl.GL_BLEND)
+    gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+
+    gl.glMatrixMode(gl.GL_PROJECTION)
+    gl.glPushMatrix()
+    gl.glLoadIdentity()
+    gl.glOrtho(0, 1, 0, 1, -1, 1)
+    gl.glMatrixMode(gl.GL_MODELVIEW)
+    gl.glPushMatrix()
+    gl.glLoadIdentity()
+
+    # 画像の1行目が画面の上端になるようにテクスチャ座標の上下を反転する
+    gl.glBegin(gl.GL_QUADS)
+    gl.glTexCoord2i(0, 1)
+    gl.glVertex2i(0, 0)
+    gl.glTexCoord2i(1, 1)
+    gl.glVertex2i(1, 0)
+    gl.glTexCoord2i(1, 0)
+    gl.glVertex2i(1, 1)
+    gl.glTexCoord2i(0, 0)
+    gl.glVertex2i(0, 1)
+    gl.glEnd()
+
+    gl.glPopMatrix()
+    gl.glMatrixMode(gl.GL_PROJECTION)
+    gl.glPopMatrix()
+    gl.glMatrixMode(gl.GL_MODELVIEW)
+
+    gl.glColor4f(1, 1, 1, 1)
+    gl.glDisable(gl.GL_BLEND)
+    gl.glEnable(gl.GL_DEPTH_TEST)
+    gl.glDisable(gl.GL_TEXTURE_2D)
+
+def start_shadow_pipeline(video_path, reference_path=None, homography_path=None):
+    """start the camera -> overlay pipeline; the projector size is the window size"""
+    source = shadow_removal.VideoFileSource(video_path)
+    if reference_path:
+        reference = cv2.imread(reference_path)
+        if reference is None:
+            raise IOError("cannot read reference image: {}".format(reference_path))
+    else:
+        reference = source.read()
+        if reference is None:
+            raise IOError("no frame in video source: {}".format(video_path))
+
+    if homography_path:
+        H = np.load(homography_path)
+    else:
+        # カメラ画像全体がプロジェクタ画面全体に対応すると仮定する
+        ch, cw = reference.shape[:2]
+        pw, ph = window.get_size()
+        H = np.diag([pw / float(cw), ph / float(ch), 1.0])
+
+    compensator = shadow_removal.ShadowCompensator(reference, window.get_size(), shadow_removal.HomographyCache(H))
+    return shadow_removal.ShadowPipeline(source, compensator).start()
+
+
+#-------------------------------
+# 輝度補償のキャリブレーション
+#-------------------------------
+def show_flat_field(level):
+    size = (board_content.width, board_content.height)
+    load_png(Image.new("RGB", size, (level, level, level)), correct=False)
+    print("radiometric calibration: projecting level", level)
+
+def start_radiometric_calibration(capture_dir, camera=None, n_levels=radiometric.DEFAULT_LEVELS, homography_path=None):
+    """project flat-field levels through the board pass and capture each one"""
+    global calibration
+
+    os.makedirs(capture_dir, exist_ok=True)
+    capture = None
+    if camera is not None:
+        capture = cv2.VideoCapture(int(camera) if camera.isdigit() else camera)
+        if not capture.isOpened():
+            raise IOError("cannot open camera: {}".format(camera))
+
+    calibration = {
+        "dir": capture_dir,
+        "levels": radiometric.flat_field_levels(n_levels),
+        "index": 0,
+        "capture": capture,
+        "homography": np.load(homography_path) if homography_path else None,
+    }
+    show_flat_field(calibration["levels"][0])
+    pyglet.clock.schedule_interval(radiometric_calibration_step, CALIB_SETTLE_TIME)
+
+def radiometric_calibration_step(dt):
+    global calibration, radiometric_model
+
+    c = calibration
+    level = c["levels"][c["index"]]
+    if c["capture"] is not None:
+        for _ in range(CALIB_FLUSH_FRAMES):
+            c["capture"].grab()
+        ok, frame = c["capture"].read()
+        if not ok:
+            print("radiometric calibration: camera read failed at level", level)
+        else:
+            cv2.imwrite(os.path.join(c["dir"], radiometric.CAPTURE_PATTERN.format(level)), frame)
+
+    c["index"] += 1
+    if c["index"] < len(c["levels"]):
+        show_flat_field(c["levels"][c["index"]])
+        return
+
+    # 全レベルを投影し終えた
+    pyglet.clock.unschedule(radiometric_calibration_step)
+    if c["capture"] is not None:
+        c["capture"].release()
+        size = (board_content.width, board_content.height)
+        radiometric_model = radiometric.fit_model(c["dir"], size, homography=c["homography"])
+        model_path = os.path.join(c["dir"], radiometric.MODEL_FILENAME)
+        radiometric_model.save(model_path)
+        print("radiometric calibration: saved", model_path)
+    calibration = None
+    load_png(board_content)
 
 #-------------------------------
 # ここからイベント関数
@@ -356,6 +559,9 @@ def on_key_press_impl(symbol, modifiers):
     if symbol == pyglet.window.key.G:
         state.draw_grid ^= True
 
+    if symbol == pyglet.window.key.O:
+        state.draw_shadow ^= True
+
     if symbol == pyglet.window.key.Q:
         window.close()
 
@@ -470,6 +676,12 @@ def on_draw_impl():
     if state.draw_board:
         # board()
         board_test()
+    if shadow_pipeline is not None:
+        if state.draw_board and state.draw_shadow and calibration is None:
+            shadow_overlay_pass()
+        else:
+            # オーバーレイを出していないことを伝える（黒く抜いた前提で比較しないように）
+            shadow_pipeline.compensator.set_projected(None)
         
 
     # カメラ座標軸の描画
@@ -486,16 +698,32 @@ def on_draw_impl():
         axes()
     #====================================================
 
-wolf_image = pyglet.image.load("data/wolf.png")
-
 #-------------------------------
 # ここからがメイン部分
 #-------------------------------
 # メインの処理
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shadow-video", default=None)
+    parser.add_argument("--shadow-reference", default=None)
+    parser.add_argument("--shadow-homography", default=None)
+    parser.add_argument("--radiometric-model", default=None)
+    parser.add_argument("--calibrate-radiometric", default=None)
+    parser.add_argument("--camera", default=None)
+    parser.add_argument("--levels", type=int, default=radiometric.DEFAULT_LEVELS)
+    parser.add_argument("--radiometric-homography", default=None)
+    args = parser.parse_args(add_profile_option())
+    PROFILER.mark("script start")
+
+    # 画像のデコードはウインドウ作成と並行して別スレッドで行う
+    loader = ThreadPoolExecutor(max_workers=2)
+    assets = start_loading_assets(loader)
 
     # アプリクラスのインスタンス
     state = AppState(PARAMS)
+    PROFILER.mark("app state")
 
     #-------------------------------
     # ここから描画準備：Pyglet
@@ -518,10 +746,12 @@ if __name__ == '__main__':
         vsync=False,
         fullscreen=True,
         screen=target_screen)
+    PROFILER.mark("window created")
 
     @window.event
     def on_draw():
         on_draw_impl()
+        PROFILER.frame_drawn()
 
     @window.event
     def on_key_press(symbol, modifiers):
@@ -547,11 +777,31 @@ if __name__ == '__main__':
     # OpenGL 用の変数の準備
     #------------------------------
     # チェスボードの作成
-    texture_ids = (pyglet.gl.GLuint * 1)()
+    texture_ids = (pyglet.gl.GLuint * 2)()   # [0]: ボード, [1]: 影補償オーバーレイ
     gl.glGenTextures(2, texture_ids)
     # load_chessboard()
-    load_png()
+    if args.radiometric_model:
+        radiometric_model = radiometric.RadiometricModel.load(args.radiometric_model)
+    board_content = assets["board"].result()
+    load_png(board_content)
+    load_wolf(assets["wolf"].result())
+    loader.shutdown(wait=False)
+    PROFILER.mark("textures uploaded")
+
+    if args.shadow_video:
+        shadow_pipeline = start_shadow_pipeline(args.shadow_video, args.shadow_reference, args.shadow_homography)
+        # 入力イベントがなくても毎フレーム on_draw が呼ばれ、最新のオーバーレイを取り込むようにする
+        pyglet.clock.schedule_interval(lambda dt: None, shadow_removal.FRAME_BUDGET)
+
+    if args.calibrate_radiometric:
+        start_radiometric_calibration(args.calibrate_radiometric, args.camera, args.levels, args.radiometric_homography)
 
     # Start
     pyglet.app.run()
 
+    if shadow_pipeline is not None:
+        shadow_pipeline.stop()
+        summary = shadow_pipeline.stats.summary()
+        if summary["frames"]:
+            print("shadow overlay latency: mean {mean_ms:.2f} ms / p95 {p95_ms:.2f} ms / max {max_ms:.2f} ms".format(**summary))
+
@@ -0,0 +1,191 @@
+"""
+バンプマップ（高さマップ）から接空間法線マップを作る前処理
+
+Usage:
+------
+    python normal_map.py 12221_Cat_v1_l3.mtl [--strength 1.0] [--cache-dir DIR]
+
+.mtl の map_bump / bump に書かれた画像を Sobel 勾配で法線マップに変換し、
+キャッシュディレクトリに PNG として保存する。
+キャッシュは「元画像のハッシュ + パラメータ」で管理するので、
+同じバンプマップを使うマテリアルが複数あっても計算は1回で済む。
+"""
+
+import os
+import sys
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from startup import lazy_import
+
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+
+#===============================
+# 定数
+#===============================
+NORMAL_MAP_VERSION = 1        # 計算方法を変えたら上げる（キャッシュの無効化用）
+DEFAULT_STRENGTH = 1.0        # 勾配の強さ
+DEFAULT_TILE_ROWS = 256       # 1スレッドが処理する行数 [px]
+CACHE_DIRNAME = "cache"
+
+BUMP_KEYWORDS = ("map_bump", "bump")
+
+#===============================
+# 法線マップの計算
+#===============================
+def _sobel_tile(padded, out, y0, y1, strength):
+    # padded は上下左右に1画素ずつ拡張済みなので、行 y0..y1 の近傍は padded[y0:y1 + 2]
+    p = padded[y0:y1 + 2]
+    gx = (p[:-2, 2:] + 2 * p[1:-1, 2:] + p[2:, 2:]) - (p[:-2, :-2] + 2 * p[1:-1, :-2] + p[2:, :-2])
+    gy = (p[2:, :-2] + 2 * p[2:, 1:-1] + p[2:, 2:]) - (p[:-2, :-2] + 2 * p[:-2, 1:-1] + p[:-2, 2:])
+
+    # 画像の行は下向き、接空間の Y は上向き（OpenGL 形式）なので gy の符号は反転しない
+    n = out[y0:y1]
+    n[..., 0] = -gx * strength
+    n[..., 1] = gy * strength
+    n[..., 2] = 1.0
+    n /= np.sqrt(np.sum(n * n, axis=2, keepdims=True))
+
+def bump_to_normal(height, strength=DEFAULT_STRENGTH, tile_rows=DEFAULT_TILE_ROWS, max_workers=None):
+    """convert a HxW height map (values in [0, 1]) to a HxWx3 float32 unit normal map"""
+    height = np.asarray(height, dtype=np.float32)
+    if height.ndim != 2:
+        raise ValueError("height map must be 2-dimensional, got shape {}".format(height.shape))
+
+    h, w = height.shape
+    padded = np.pad(height, 1, mode="edge")
+    out = np.empty((h, w, 3), dtype=np.float32)
+
+    bands = [(y0, min(y0 + tile_rows, h)) for y0 in range(0, h, tile_rows)]
+    if len(bands) == 1:
+        _sobel_tile(padded, out, 0, h, strength)
+        return out
+
+    # NumPy の演算中は GIL が外れるので、行方向のタイルをスレッドで並列に処理できる
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_sobel_tile, padded, out, y0, y1, strength) for y0, y1 in bands]
+        for f in futures:
+            f.result()
+    return out
+
+def encode_normal(normal):
+    """map a unit normal map to RGB uint8 ([-1, 1] -> [0, 255])"""
+    return np.clip(np.rint((normal * 0.5 + 0.5) * 255), 0, 255).astype(np.uint8)
+
+def load_height(filepath):
+    image = Image.open(filepath).convert("L")
+    return np.asarray(image, dtype=np.float32) / 255.0
+
+#===============================
+# キャッシュ
+#===============================
+class NormalMapCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._memo = {}                # キー -> 出力ファイルパス
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def key(self, source_path, strength):
+        with open(source_path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        params = "v{}:strength={!r}".format(NORMAL_MAP_VERSION, float(strength))
+        return hashlib.sha1((digest + ":" + params).encode("ascii")).hexdigest()
+
+    def path_for(self, source_path, key):
+        stem = os.path.splitext(os.path.basename(source_path))[0]
+        return os.path.join(self.cache_dir, "{}_{}_normal.png".format(stem, key[:16]))
+
+    def get(self, source_path, strength=DEFAULT_STRENGTH):
+        """return the path of the normal map for source_path, computing it only if not cached"""
+        key = self.key(source_path, strength)
+        with self._lock:
+            if key in self._memo:
+                return self._memo[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # 同じキーを複数スレッドが同時に計算しないようにする
+        with key_lock:
+            with self._lock:
+                if key in self._memo:
+                    return self._memo[key]
+
+            out_path = self.path_for(source_path, key)
+            if not os.path.exists(out_path):
+                normal = bump_to_normal(load_height(source_path), strength)
+                os.makedirs(self.cache_dir, exist_ok=True)
+                # 書きかけのファイルを読まれないよう、一時ファイルに書いてから置き換える
+                tmp_path = out_path + ".tmp"
+                Image.fromarray(encode_normal(normal), "RGB").save(tmp_path, format="PNG")
+                os.replace(tmp_path, out_path)
+
+            with self._lock:
+                self._memo[key] = out_path
+        return out_path
+
+#===============================
+# マテリアル（.mtl）の前処理
+#===============================
+def parse_mtl(mtl_path):
+    """return {material name: {keyword: value}} from a Wavefront .mtl file"""
+    materials = {}
+    current = None
+    with open(mtl_path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            # キーワードと値の区切りは空白でもタブでもよい
+            fields = line.split(None, 1)
+            keyword = fields[0]
+            value = fields[1].strip() if len(fields) > 1 else ""
+            if keyword == "newmtl":
+                current = materials.setdefault(value, {})
+            elif current is not None:
+                current[keyword] = value
+    return materials
+
+def _bump_filename(value):
+    # "bump -bm 0.5 Cat_bump.jpg" のようなオプション付きの書き方ではファイル名は最後
+    return value.split()[-1]
+
+def preprocess_materials(mtl_path, strength=DEFAULT_STRENGTH, cache=None, max_workers=None):
+    """add a 'map_normal' entry to every bump-mapped material in mtl_path"""
+    base_dir = os.path.dirname(os.path.abspath(mtl_path))
+    if cache is None:
+        cache = NormalMapCache(os.path.join(base_dir, CACHE_DIRNAME))
+
+    materials = parse_mtl(mtl_path)
+    jobs = {}
+    for name, material in materials.items():
+        for keyword in BUMP_KEYWORDS:
+            if keyword in material:
+                jobs[name] = os.path.join(base_dir, _bump_filename(material[keyword]))
+                break
+
+    # マテリアル単位でも並列化する（同じ画像はキャッシュ側で1回だけ計算される）
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {name: executor.submit(cache.get, path, strength) for name, path in jobs.items()}
+        for name, future in futures.items():
+            materials[name]["map_normal"] = future.result()
+    return materials
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="generate normal maps from the bump maps of a .mtl file")
+    parser.add_argument("mtl")
+    parser.add_argument("--strength", type=float, default=DEFAULT_STRENGTH)
+    parser.add_argument("--cache-dir", default=None)
+    args = parser.parse_args()
+
+    cache = NormalMapCache(args.cache_dir) if args.cache_dir else None
+    materials = preprocess_materials(args.mtl, args.strength, cache)
+    for name, material in materials.items():
+        if "map_normal" in material:
+            print("{}: {}".format(name, material["map_normal"]))
+    if not any("map_normal" in m for m in materials.values()):
+        print("no bump-mapped materials in {}".format(args.mtl), file=sys.stderr)
@@ -1,6 +1,13 @@
+import os
 import pyglet
 from pyglet.gl import *
-from PIL import Image
+
+from startup import lazy_import
+from sprite_layer import SpriteLayer
+
+Image = lazy_import("PIL.Image")
+
+DATA_DIRPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 
 def resize_texture(texture, new_width, new_height):
     # Get the pixel data from the original texture
@@ -16,7 +23,7 @@ def resize_texture(texture, new_width, new_height):
     return new_texture_id
 
 def load_texture(filename):
-    image = Image.open(filename)
+    image = Image.open(os.path.join(DATA_DIRPATH, filename))
     image_data = image.tobytes("raw", "RGB", 0, -1)
     width, height = image.size
 
@@ -32,21 +39,6 @@ def load_texture(filename):
 # Window dimensions
 WIDTH, HEIGHT = 1200, 1000
 
-# Load textures
-texture1_id, texture1_width, texture1_height = load_texture('data/back.JPG')
-texture2_id, texture2_width, texture2_height = load_texture('data/wolf.png')
-
-# Create vertex list for quad
-vertex_list_back = pyglet.graphics.vertex_list(4,
-    ('v2f', [0, 0, WIDTH, 0, WIDTH, HEIGHT, 0, HEIGHT]),
-    ('t2f', [0, 0, 1, 0, 1, 1, 0, 1])
-)
-WIDTH, HEIGHT = 200, 200
-vertex_list_front = pyglet.graphics.vertex_list(4,
-    ('v2f', [0, 0, WIDTH, 0, WIDTH, HEIGHT, 0, HEIGHT]),
-    ('t2f', [0, 0, 1, 0, 1, 1, 0, 1])
-)
-
 # Initial positions
 texture1_x = 0
 texture1_y = 0
@@ -56,27 +48,20 @@ texture2_y = 100
 # Create window
 window = pyglet.window.Window(WIDTH, HEIGHT, resizable=True)
 
+# Load textures (after the window so that it appears as early as possible)
+texture1_id, texture1_width, texture1_height = load_texture('back.JPG')
+texture2_id, texture2_width, texture2_height = load_texture('wolf.png')
+
+# All layers live in one sprite layer and are drawn with one call per texture
+sprites = SpriteLayer()
+back_sprite = sprites.add(texture1_id.value, texture1_x, texture1_y, WIDTH, HEIGHT)
+front_sprite = sprites.add(texture2_id.value, texture2_x, texture2_y, 200, 200)
+dragged_sprite = -1
+
 @window.event
 def on_draw():
     window.clear()
-
-    glEnable(GL_TEXTURE_2D)
-
-    # Bind and draw texture1
-    glBindTexture(GL_TEXTURE_2D, texture1_id)
-    glPushMatrix()
-    glTranslatef(texture1_x, texture1_y, 0)
-    vertex_list_back.draw(GL_QUADS)
-    glPopMatrix()
-
-    # Bind and draw texture2 overlaid on texture1
-    glBindTexture(GL_TEXTURE_2D, texture2_id)
-    glPushMatrix()
-    glTranslatef(texture2_x, texture2_y, 0)
-    vertex_list_front.draw(GL_QUADS)
-    glPopMatrix()
-
-    glDisable(GL_TEXTURE_2D)
+    sprites.draw()
 
 @window.event
 def on_resize(width, height):
@@ -87,14 +72,23 @@ def on_resize(width, height):
     glMatrixMode(GL_MODELVIEW)
     return pyglet.event.EVENT_HANDLED
 
+@window.event
+def on_mouse_press(x, y, button, modifiers):
+    global dragged_sprite
+    if button & pyglet.window.mouse.LEFT:
+        dragged_sprite = sprites.hit_test(x, y)
+
+@window.event
+def on_mouse_release(x, y, button, modifiers):
+    global dragged_sprite
+    if button & pyglet.window.mouse.LEFT:
+        dragged_sprite = -1
+
 @window.event
 def on_mouse_drag(x, y, dx, dy, buttons, modifiers):
-    global texture1_x, texture1_y, texture2_x, texture2_y
     if buttons & pyglet.window.mouse.RIGHT:
-        texture1_x += dx
-        texture1_y += dy
-    if buttons & pyglet.window.mouse.LEFT:
-        texture2_x += dx
-        texture2_y += dy
+        sprites.move(back_sprite, dx, dy)
+    if buttons & pyglet.window.mouse.LEFT and dragged_sprite >= 0:
+        sprites.move(dragged_sprite, dx, dy)
 
 pyglet.app.run()
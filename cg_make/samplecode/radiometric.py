@@ -0,0 +1,224 @@
+"""
+投影面の色・模様のムラを補正する輝度補償（radiometric compensation）
+
+1. 一様な明るさ（flat-field）の画像をいくつかのレベルで投影し、カメラで撮影して
+   CAPTURE_PATTERN の名前でディレクトリに保存する（OpenGL_sample.py --calibrate-radiometric）
+2. fit_model() で撮影画像を1枚ずつ読みながら、ブロックごと・チャンネルごとの
+   応答（投影レベル -> 撮影値）を集め、どのブロックでも実現できる明るさの範囲を目標にして
+   「画素値 -> 投影値」の逆応答テーブル（ブロック x ブロック x 3 x 256 の LUT）を作る
+   （プロジェクタ・カメラの応答はガンマのため非線形なので、直線ではなく区分線形で逆引きする）
+3. 実行時は RadiometricModel.apply() で、周囲4ブロックの LUT を引いて双線形に補間し
+   （cv2.remap で1チャンネル1回の参照）、補正した画像をテクスチャに転送する
+
+Usage:
+------
+    python radiometric.py CAPTURE_DIR WIDTH HEIGHT [--block 16] [--homography H.npy] [-o model.npz]
+"""
+
+import os
+import re
+
+from startup import lazy_import
+
+np = lazy_import("numpy")
+cv2 = lazy_import("cv2")
+
+#===============================
+# 定数
+#===============================
+CAPTURE_PATTERN = "level_{:03d}.png"   # 撮影画像のファイル名（投影レベル 0-255）
+CAPTURE_REGEX = re.compile(r"^level_(\d{3})\.png$")
+MODEL_FILENAME = "radiometric_model.npz"
+
+DEFAULT_LEVELS = 9            # flat-field のレベル数
+DEFAULT_BLOCK = 16            # モデルのブロックサイズ [px]（コンテンツ画像の座標）
+TARGET_PERCENTILE = 5         # 目標応答を決めるパーセンタイル（外れ値を避ける）
+MIN_STEP = 1e-4              # 応答を狭義単調増加にするための最小の増分
+REMAP_MAX_COORD = 32767      # cv2.remap が扱える座標の上限（内部で 16bit 整数に変換される）
+
+def flat_field_levels(n=DEFAULT_LEVELS):
+    """evenly spaced projection levels from 0 to 255"""
+    return [int(round(v)) for v in np.linspace(0, 255, n)]
+
+def list_captures(capture_dir):
+    """[(level, path)] of the flat-field captures in capture_dir, sorted by level"""
+    captures = []
+    for filename in os.listdir(capture_dir):
+        m = CAPTURE_REGEX.match(filename)
+        if m:
+            captures.append((int(m.group(1)), os.path.join(capture_dir, filename)))
+    return sorted(captures)
+
+#===============================
+# モデル
+#===============================
+class RadiometricModel:
+    """per-block inverse response LUT: projected = lut[block y, block x, channel, content] (RGB order)"""
+
+    def __init__(self, lut, size):
+        self.lut = np.ascontiguousarray(lut, dtype=np.uint8)   # (by, bx, 3, 256)
+        self.size = tuple(size)                                # 当てはめたコンテンツ画像の (width, height)
+        self._maps = {}                                        # (width, height) -> 画素 -> ブロック座標
+        self._remap_tables = None
+
+    def save(self, path):
+        np.savez_compressed(path, lut=self.lut, size=np.asarray(self.size))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["lut"], tuple(int(v) for v in data["size"]))
+
+    def _axis(self, n_pixels, n_blocks):
+        # 画素中心をブロック中心の格子に対応させる（端のブロックより外側は端の値）
+        u = (np.arange(n_pixels, dtype=np.float32) + 0.5) * (n_blocks / float(n_pixels)) - 0.5
+        return np.clip(u, 0, n_blocks - 1).astype(np.float32)
+
+    def _maps_for(self, width, height):
+        key = (width, height)
+        if key not in self._maps:
+            by, bx = self.lut.shape[:2]
+            ux = np.ascontiguousarray(np.broadcast_to(self._axis(width, bx)[None, :], (height, width)))
+            vy = self._axis(height, by)[:, None]
+            self._maps[key] = (ux, vy)
+        return self._maps[key]
+
+    def _tables(self):
+        # チャンネルごとに LUT を (256 * by, bx) の画像として並べる（行 = 画素値 * by + ブロック y）。
+        # 画素値ごとの帯の中では上下左右の隣がそのまま隣のブロックなので、
+        # cv2.remap の双線形補間で周囲4ブロックの補間と LUT の参照が一度にできる
+        if self._remap_tables is None:
+            by, bx = self.lut.shape[:2]
+            self._remap_tables = [np.ascontiguousarray(self.lut[..., ch, :].transpose(2, 0, 1).reshape(256 * by, bx))
+                                  for ch in range(3)]
+        return self._remap_tables
+
+    def apply(self, image):
+        """correct an HxWx3 uint8 RGB image; returns a new uint8 image"""
+        h, w = image.shape[:2]
+        by = self.lut.shape[0]
+        if 256 * by > REMAP_MAX_COORD:
+            return self._apply_gather(image)
+
+        ux, vy = self._maps_for(w, h)
+        out = []
+        for table, channel in zip(self._tables(), cv2.split(image)):
+            # 帯の中の y 座標は [0, by - 1] に収めてあるので、隣の画素値の帯とは混ざらない
+            my = channel.astype(np.float32) * by + vy
+            out.append(cv2.remap(table, ux, my, cv2.INTER_LINEAR))
+        return cv2.merge(out)
+
+    def _apply_gather(self, image):
+        # ブロック数が多く remap の座標範囲を超える場合の NumPy による同等の処理（遅い）
+        h, w = image.shape[:2]
+        by, bx = self.lut.shape[:2]
+        ux, vy = self._maps_for(w, h)
+        u = ux[0]
+        v = vy[:, 0]
+        x0 = np.floor(u).astype(np.int32)
+        y0 = np.floor(v).astype(np.int32)
+        x1 = np.minimum(x0 + 1, bx - 1)
+        y1 = np.minimum(y0 + 1, by - 1)
+        fx = (u - x0)[None, :, None]
+        fy = (v - y0)[:, None, None]
+
+        # LUT を1次元にしたときの添字 = ((iy * bx + ix) * 3 + ch) * 256 + 画素値
+        flat = self.lut.reshape(-1)
+        value = image.astype(np.int32) + np.arange(3, dtype=np.int32) * 256
+
+        def gather(iy, ix):
+            base = iy[:, None, None] * (3 * 256 * bx) + ix[None, :, None] * (3 * 256)
+            return flat.take(base + value).astype(np.float32)
+
+        top = gather(y0, x0) * (1 - fx) + gather(y0, x1) * fx
+        bottom = gather(y1, x0) * (1 - fx) + gather(y1, x1) * fx
+        return np.clip(np.rint(top * (1 - fy) + bottom * fy), 0, 255).astype(np.uint8)
+
+#===============================
+# 撮影画像からの当てはめ
+#===============================
+def _read_block_means(path, size, block_shape, homography):
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise IOError("cannot read capture: {}".format(path))
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    if homography is not None:
+        image = cv2.warpPerspective(image, homography, size, flags=cv2.INTER_LINEAR)
+    elif (image.shape[1], image.shape[0]) != size:
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    # INTER_AREA の縮小はブロック内の平均になる
+    by, bx = block_shape
+    return cv2.resize(image, (bx, by), interpolation=cv2.INTER_AREA).astype(np.float32) / 255.0
+
+def _inverse_lut(levels, response, targets):
+    """projector values giving `targets` for every block, by piecewise-linear inversion
+
+    levels: (K,) projected levels in [0, 1]; response: (K, by, bx) captured values,
+    increasing along K; targets: (T,) wanted captured values. Returns (by, bx, T).
+    """
+    K = levels.size
+    r = np.moveaxis(response, 0, -1)[..., None, :]             # (by, bx, 1, K)
+    t = targets[:, None]                                       # (T, 1)
+    # 目標値を挟む2レベル j, j + 1 を探す
+    j = np.clip(np.count_nonzero(r < t, axis=-1) - 1, 0, K - 2)  # (by, bx, T)
+    r = r[..., 0, :]
+    y0 = np.take_along_axis(r, j, axis=-1)
+    y1 = np.take_along_axis(r, j + 1, axis=-1)
+    f = np.clip((targets - y0) / (y1 - y0), 0.0, 1.0)
+    return levels[j] + f * (levels[j + 1] - levels[j])
+
+def fit_model(capture_dir, size, block=DEFAULT_BLOCK, homography=None, percentile=TARGET_PERCENTILE):
+    """fit a RadiometricModel from flat-field captures, reading one image at a time
+
+    size is the (width, height) of the content image; homography maps capture
+    pixels to content pixels (None if the captures are already aligned).
+    """
+    captures = list_captures(capture_dir)
+    if len(captures) < 2:
+        raise ValueError("need at least 2 flat-field captures in {}, found {}".format(capture_dir, len(captures)))
+    if len(set(level for level, _ in captures)) != len(captures):
+        raise ValueError("duplicate flat-field levels in {}".format(capture_dir))
+
+    width, height = size
+    block_shape = (max(1, height // block), max(1, width // block))
+
+    # 撮影画像はブロック平均にしてから捨てる（保持するのは レベル数 x ブロック x 3 だけ）
+    levels = np.array([level / 255.0 for level, _ in captures], dtype=np.float32)
+    response = np.stack([_read_block_means(path, size, block_shape, homography) for _, path in captures])
+
+    # ノイズで応答が逆転しないよう、レベル方向に狭義単調増加にする
+    response = np.maximum.accumulate(response, axis=0)
+    response += MIN_STEP * np.arange(len(captures), dtype=np.float32)[:, None, None, None]
+
+    # 目標範囲は「明るいブロックの黒」から「暗いブロックの白」まで（どのブロックでも実現できる範囲）
+    t_min = np.percentile(response[0], 100 - percentile, axis=(0, 1))
+    t_max = np.percentile(response[-1], percentile, axis=(0, 1))
+    if np.any(t_max <= t_min):
+        raise ValueError("flat-field captures leave no common brightness range")
+
+    content = np.arange(256, dtype=np.float32) / 255.0
+    lut = np.empty(block_shape + (3, 256), dtype=np.uint8)
+    for ch in range(3):
+        targets = t_min[ch] + content * (t_max[ch] - t_min[ch])
+        projected = _inverse_lut(levels, response[..., ch], targets.astype(np.float32))
+        lut[..., ch, :] = np.clip(np.rint(projected * 255), 0, 255)
+    return RadiometricModel(lut, size)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="fit a radiometric compensation model from flat-field captures")
+    parser.add_argument("capture_dir")
+    parser.add_argument("width", type=int, help="content image width")
+    parser.add_argument("height", type=int, help="content image height")
+    parser.add_argument("--block", type=int, default=DEFAULT_BLOCK)
+    parser.add_argument("--homography", default=None, help="3x3 capture->content homography (.npy)")
+    parser.add_argument("-o", "--output", default=None)
+    args = parser.parse_args()
+
+    H = np.load(args.homography) if args.homography else None
+    model = fit_model(args.capture_dir, (args.width, args.height), args.block, H)
+    output = args.output or os.path.join(args.capture_dir, MODEL_FILENAME)
+    model.save(output)
+    print("saved {} ({}x{} blocks)".format(output, model.lut.shape[1], model.lut.shape[0]))
@@ -0,0 +1,543 @@
+"""
+人の影（遮蔽）を検出して補償オーバーレイを作るパイプライン
+
+カメラ画像と「遮蔽がないときに見えるはずの画像」（参照画像）の差分から遮蔽マスクを作り、
+ホモグラフィでプロジェクタ座標に変換してオーバーレイ（1チャンネルのアルファマスク）にする。
+マスクは縮小した解像度のまま扱い、画面全体への拡大は描画時にテクスチャの補間で行う。
+
+    [producer] FrameSource -> frames queue -> [worker] ShadowCompensator -> overlays queue -> [consumer] 描画
+
+キューは最新の1件だけを保持し、処理が追いつかないときは古いフレームを捨てて常に最新のフレームを処理する。
+カメラには投影中のオーバーレイ（黒く抜いた部分）も写るので、参照画像にもオーバーレイを掛けてから比較する。
+
+Usage:
+------
+    python shadow_removal.py [--frames 300] [--size 1920x1080]   # 合成映像での確認（p95 の予算超過・マスクが消えない場合は終了コード 1）
+    python shadow_removal.py --video camera.mp4 --reference board.png
+"""
+
+import time
+import queue
+import threading
+
+from startup import lazy_import
+
+np = lazy_import("numpy")
+cv2 = lazy_import("cv2")
+
+#===============================
+# 定数
+#===============================
+FRAME_BUDGET = 1.0 / 60.0   # 1フレームの許容時間 [s]（60 FPS）
+
+DIFF_THRESHOLD = 40         # 遮蔽とみなす輝度差 [0-255]
+MASK_SCALE = 0.5            # マスク計算・オーバーレイの縮小率（1080p -> 540p）
+MORPH_KERNEL = 5            # モルフォロジー処理のカーネルサイズ [px]（縮小後）
+FEATHER = 5                 # マスク境界のぼかし幅 [px]（縮小後）
+OVERLAY_DECAY = 32          # 検出されなくなった部分のアルファを1フレームごとに下げる量 [0-255]
+MIN_THRESHOLD_RATIO = 0.25  # 黒く抜いた部分のしきい値の下限（DIFF_THRESHOLD に対する比）
+QUEUE_SIZE = 1              # 各キューの上限（最新の1件だけを持つ）
+DEFAULT_VIDEO_FPS = 30.0    # 動画ファイルにフレームレートが記録されていない場合の再生速度
+
+#===============================
+# 入力フレーム
+#===============================
+class FramePacer:
+    """sleeps so that successive wait() calls return at most `fps` times per second"""
+
+    def __init__(self, fps):
+        self.period = None if not fps else 1.0 / fps   # None なら待たない
+        self._next = None
+
+    def wait(self):
+        if self.period is None:
+            return
+        now = time.perf_counter()
+        if self._next is None:
+            self._next = now
+        elif now < self._next:
+            time.sleep(self._next - now)
+        else:
+            # 遅れた分は取り戻さない（まとめて返すと実カメラと違う挙動になる）
+            self._next = now
+        self._next += self.period
+
+
+class VideoFileSource:
+    """frames from a video file (or camera index) via cv2.VideoCapture, paced at the video's frame rate"""
+
+    def __init__(self, path, fps=None):
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise IOError("cannot open video source: {}".format(path))
+        if fps is None:
+            fps = self.capture.get(cv2.CAP_PROP_FPS) or DEFAULT_VIDEO_FPS
+        self.fps = fps
+        self.pacer = FramePacer(fps)   # ファイルは読める限り速く読めてしまうので、カメラと同じ速さで返す
+
+    def read(self):
+        ok, frame = self.capture.read()
+        if not ok:
+            return None
+        self.pacer.wait()
+        return frame
+
+    def close(self):
+        self.capture.release()
+
+
+class SyntheticSource:
+    """reference image with a dark rectangle (a 'person') moving across it"""
+
+    def __init__(self, reference, n_frames, occluder_size=(0.15, 0.6), darkness=0.2, fps=None, leave_at=None):
+        self.reference = reference
+        self.n_frames = n_frames
+        self.leave_at = n_frames if leave_at is None else leave_at   # このフレーム以降は人がいない
+        self.index = 0
+        self.pacer = FramePacer(fps)   # カメラのフレームレートを模擬する（None なら待たずに次々と返す）
+        h, w = reference.shape[:2]
+        self.occ_w = int(w * occluder_size[0])
+        self.occ_h = int(h * occluder_size[1])
+        self.darkness = darkness
+
+    def read(self):
+        if self.index >= self.n_frames:
+            return None
+        self.pacer.wait()
+        h, w = self.reference.shape[:2]
+        frame = self.reference.copy()
+        if self.index < self.leave_at:
+            x = int((w - self.occ_w) * (self.index / max(self.n_frames - 1, 1)))
+            y = h - self.occ_h
+            region = frame[y:y + self.occ_h, x:x + self.occ_w]
+            region[:] = (region * self.darkness).astype(np.uint8)
+        self.index += 1
+        return frame
+
+    def close(self):
+        pass
+
+
+class FeedbackSource(SyntheticSource):
+    """SyntheticSource whose camera also sees the overlay being projected
+
+    Set `projected` from the render loop to the overlay currently on screen
+    (projector-space alpha at `overlay_scale`); the board is darkened where it
+    is blanked out, as the real camera would see it.
+    """
+
+    def __init__(self, reference, n_frames, homography, overlay_scale=MASK_SCALE, **kwargs):
+        super().__init__(reference, n_frames, **kwargs)
+        # カメラ画像の画素 -> オーバーレイの画素
+        S = np.diag([overlay_scale, overlay_scale, 1.0])
+        self.camera_to_overlay = S @ np.asarray(homography, np.float64)
+        self.projected = None
+        self.blanked = []   # フレームごとの、オーバーレイで黒く抜かれていた画素数
+
+    def read(self):
+        frame = super().read()
+        if frame is None:
+            return None
+        projected = self.projected
+        if projected is None:
+            self.blanked.append(0)
+            return frame
+        h, w = frame.shape[:2]
+        alpha = cv2.warpPerspective(projected, self.camera_to_overlay, (w, h),
+                                    flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+        self.blanked.append(int(np.count_nonzero(alpha > 127)))
+        return cv2.multiply(frame, cv2.merge([255 - alpha] * 3), scale=1.0 / 255)
+
+
+def make_test_pattern(width, height):
+    """colourful gradient used as the synthetic reference image"""
+    xs = np.linspace(0, 255, width, dtype=np.float32)
+    ys = np.linspace(0, 255, height, dtype=np.float32)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[..., 0] = xs[None, :]
+    image[..., 1] = ys[:, None]
+    image[..., 2] = 255 - xs[None, :] * 0.5
+    return image
+
+#===============================
+# ホモグラフィ（カメラ -> プロジェクタ）
+#===============================
+class HomographyCache:
+    """keeps the camera->projector homography, recomputing only when the inputs change"""
+
+    def __init__(self, homography=None):
+        self._homography = None if homography is None else np.asarray(homography, np.float64)
+        self._points_key = None
+        self._scaled = {}   # マスクの縮小率 -> 縮小済みマスクから直接使えるホモグラフィ
+
+    def from_points(self, camera_points, projector_points):
+        key = (np.asarray(camera_points, np.float32).tobytes(), np.asarray(projector_points, np.float32).tobytes())
+        if key != self._points_key:
+            H, _ = cv2.findHomography(np.asarray(camera_points, np.float32),
+                                      np.asarray(projector_points, np.float32), cv2.RANSAC)
+            if H is None:
+                raise ValueError("could not estimate a homography from the given points")
+            self._homography = H
+            self._points_key = key
+            self._scaled.clear()
+        return self._homography
+
+    def for_scale(self, scale):
+        """homography between camera and projector images both downscaled by `scale`"""
+        if self._homography is None:
+            raise ValueError("homography is not set")
+        if scale not in self._scaled:
+            S = np.diag([scale, scale, 1.0])
+            S_inv = np.diag([1.0 / scale, 1.0 / scale, 1.0])
+            self._scaled[scale] = S @ self._homography @ S_inv
+        return self._scaled[scale]
+
+#===============================
+# 遮蔽マスクと補償オーバーレイ
+#===============================
+class ShadowCompensator:
+    """camera frame -> occlusion mask -> projector-space alpha mask (255 = blank out)
+
+    The returned mask is projector_size * scale; it is stretched to the full
+    projector image when drawn. Call set_projected() with the mask currently
+    on screen so that the blanked-out board is not mistaken for an occlusion.
+    """
+
+    def __init__(self, reference, projector_size, homography_cache,
+                 threshold=DIFF_THRESHOLD, scale=MASK_SCALE, kernel=MORPH_KERNEL, feather=FEATHER,
+                 decay=OVERLAY_DECAY):
+        self.projector_size = projector_size   # (width, height)
+        self.homography_cache = homography_cache
+        self.threshold = threshold
+        self.scale = scale
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel, kernel))
+        self.feather = feather | 1
+        self.decay = decay
+        pw, ph = projector_size
+        self.overlay_size = (max(1, int(round(pw * scale))), max(1, int(round(ph * scale))))
+        self._projected = None   # 投影中のオーバーレイ（描画側のスレッドから差し替えられる）
+        self._expected = None    # (投影中のオーバーレイ, 期待されるカメラ画像, 画素ごとのしきい値)
+        self._last = None        # 前回返したオーバーレイ
+        self.set_reference(reference)
+
+    def _prepare(self, frame):
+        # 先に縮小してからグレースケールにする（変換する画素数を減らす）
+        if self.scale != 1.0:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+
+    def set_reference(self, reference):
+        self.reference = self._prepare(reference)
+        self._expected = None
+        self._last = None
+
+    def set_projected(self, overlay):
+        """tell the compensator which overlay is on screen now (None = nothing)"""
+        self._projected = overlay
+
+    def expected(self):
+        """(image, threshold) the camera frame is compared with, given the overlay on screen
+
+        The reference is darkened where the overlay blanks it out, and the
+        threshold shrinks with the light that is left there (it is a scalar
+        when nothing is projected).
+        """
+        projected = self._projected
+        if projected is None:
+            return self.reference, self.threshold
+        cached = self._expected
+        if cached is not None and cached[0] is projected:
+            return cached[1:]
+        # オーバーレイをマスクの座標に戻し、黒く抜いた分だけ参照画像を暗くする
+        h, w = self.reference.shape[:2]
+        H = self.homography_cache.for_scale(self.scale)
+        alpha = cv2.warpPerspective(projected, H, (w, h), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+        light = 255 - alpha
+        expected = cv2.multiply(self.reference, light, scale=1.0 / 255)
+        # 暗くした部分では人と板の差も同じ割合で小さくなる
+        threshold = cv2.multiply(cv2.max(light, int(255 * MIN_THRESHOLD_RATIO)), self.threshold, scale=1.0 / 255)
+        self._expected = (projected, expected, threshold)
+        return expected, threshold
+
+    def occlusion_mask(self, frame):
+        """uint8 mask (255 = occluded) at the reduced mask resolution"""
+        gray = self._prepare(frame)
+        expected, threshold = self.expected()
+        diff = cv2.absdiff(gray, expected)
+        mask = cv2.compare(diff, threshold, cv2.CMP_GT)
+        # 小さなノイズを消してから穴を埋める
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, self.kernel)
+        return mask
+
+    def __call__(self, frame):
+        mask = self.occlusion_mask(frame)
+        # 境界のぼかしは縮小したマスクの上で行ってから射影変換する
+        if self.feather > 1:
+            mask = cv2.GaussianBlur(mask, (self.feather, self.feather), 0)
+        H = self.homography_cache.for_scale(self.scale)
+        overlay = cv2.warpPerspective(mask, H, self.overlay_size, flags=cv2.INTER_LINEAR)
+        # 黒く抜いている間はそこに人がいるか見えないので、検出されなくなった部分はすぐには消さずに
+        # 少しずつ薄くする（人がいれば明るくなったところで再び検出される）
+        if self.decay and self._last is not None:
+            overlay = cv2.max(overlay, cv2.subtract(self._last, self.decay))
+        self._last = overlay
+        return overlay
+
+#===============================
+# レイテンシの計測
+#===============================
+class LatencyStats:
+    def __init__(self, budget=FRAME_BUDGET):
+        self.budget = budget
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            self.samples.append(latency)
+
+    def summary(self):
+        with self._lock:
+            s = np.asarray(self.samples, dtype=np.float64)
+        if s.size == 0:
+            return {"frames": 0}
+        return {
+            "frames": int(s.size),
+            "mean_ms": float(s.mean() * 1e3),
+            "p95_ms": float(np.percentile(s, 95) * 1e3),
+            "max_ms": float(s.max() * 1e3),
+            "over_budget": int(np.count_nonzero(s > self.budget)),
+        }
+
+#===============================
+# スレッドパイプライン
+#===============================
+def _put_latest(q, item):
+    # キューが一杯なら古いものを捨てて最新のものを入れる
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+
+class ShadowPipeline:
+    """producer/consumer pipeline; call latest() from the render loop
+
+    An exception raised while reading or processing a frame ends the pipeline
+    and is re-raised from latest() / drain().
+    """
+
+    def __init__(self, source, compensator, queue_size=QUEUE_SIZE, stats=None):
+        self.source = source
+        self.compensator = compensator
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.overlays = queue.Queue(maxsize=queue_size)
+        self.stats = stats or LatencyStats()
+        self.dropped = 0
+        self.finished = False   # ソースの終わり（またはエラー）を受け取った
+        self.error = None       # producer / worker で起きた例外
+        self._stop = threading.Event()
+        self._threads = []
+        self._current = None
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._produce, daemon=True),
+                         threading.Thread(target=self._work, daemon=True)]
+        for t in self._threads:
+            t.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout=1.0)
+        self.source.close()
+
+    def _put(self, q, item):
+        if q.full():
+            self.dropped += 1
+        _put_latest(q, item)
+
+    def _produce(self):
+        while not self._stop.is_set():
+            try:
+                frame = self.source.read()
+            except Exception as e:
+                # 終端として worker に流し、消費側で例外を投げ直させる
+                self.error = e
+                frame = None
+            t_capture = time.perf_counter()
+            self._put(self.frames, (t_capture, frame))
+            if frame is None:
+                return
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                t_capture, frame = self.frames.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if frame is None:
+                self._put(self.overlays, (t_capture, None))
+                return
+            try:
+                overlay = self.compensator(frame)
+            except Exception as e:
+                self.error = e
+                self._stop.set()
+                self._put(self.overlays, (t_capture, None))
+                return
+            self._put(self.overlays, (t_capture, overlay))
+
+    def _end(self):
+        # ソースが終わったらオーバーレイを消す（最後のマスクを出し続けない）
+        self.finished = True
+        self._current = None
+        self.compensator.set_projected(None)
+        if self.error is not None:
+            raise self.error
+
+    def latest(self):
+        """newest overlay (or the previous one if nothing new arrived); records its latency
+
+        The returned overlay is taken to be what is projected from now on.
+        Returns None once the source has ended.
+        """
+        while not self.finished:
+            try:
+                t_capture, overlay = self.overlays.get_nowait()
+            except queue.Empty:
+                break
+            if overlay is None:
+                self._end()
+                break
+            self.stats.add(time.perf_counter() - t_capture)
+            self._current = overlay
+            self.compensator.set_projected(overlay)
+        return self._current
+
+    def drain(self):
+        """consume every overlay until the source ends (for benchmarks; nothing is projected)"""
+        count = 0
+        while not self.finished:
+            t_capture, overlay = self.overlays.get()
+            if overlay is None:
+                self._end()
+                break
+            self.stats.add(time.perf_counter() - t_capture)
+            self._current = overlay
+            count += 1
+        return count
+
+
+#===============================
+# レイテンシの確認
+#===============================
+def measure_latency(source, compensator):
+    """run the pipeline until the source ends; returns (summary, frames, dropped, elapsed)"""
+    pipeline = ShadowPipeline(source, compensator).start()
+    t_start = time.perf_counter()
+    try:
+        n = pipeline.drain()
+    finally:
+        pipeline.stop()
+    elapsed = time.perf_counter() - t_start
+    return pipeline.stats.summary(), n, pipeline.dropped, elapsed
+
+def check_synthetic_latency(width=1920, height=1080, n_frames=300, fps=60.0, budget=FRAME_BUDGET):
+    """run the synthetic camera through the pipeline and assert p95 latency <= budget"""
+    reference = make_test_pattern(width, height)
+    source = SyntheticSource(reference, n_frames, fps=fps)
+    compensator = ShadowCompensator(reference, (width, height), HomographyCache(np.eye(3)))
+    summary, n, dropped, elapsed = measure_latency(source, compensator)
+    assert n > 0, "no overlay was produced"
+    assert summary["p95_ms"] <= budget * 1e3, \
+        "p95 latency {:.2f} ms exceeds the {:.2f} ms budget".format(summary["p95_ms"], budget * 1e3)
+    return summary
+
+def check_overlay_feedback(width=960, height=540, n_frames=120, leave_at=60, fps=30.0, settle_frames=10):
+    """project the overlay back into a synthetic camera and assert the mask neither grows nor latches
+
+    A person walks across the board for `leave_at` frames and then leaves;
+    within `settle_frames` of leaving nothing may be blanked any more.
+    Returns the number of blanked camera pixels per frame.
+    """
+    reference = make_test_pattern(width, height)
+    H = np.eye(3)
+    source = FeedbackSource(reference, n_frames, H, fps=fps, leave_at=leave_at)
+    compensator = ShadowCompensator(reference, (width, height), HomographyCache(H))
+    pipeline = ShadowPipeline(source, compensator).start()
+    try:
+        # 描画ループの代わり：最新のオーバーレイを「投影」する
+        while not pipeline.finished:
+            source.projected = pipeline.latest()
+            time.sleep(1.0 / fps / 2)
+    finally:
+        pipeline.stop()
+
+    blanked = source.blanked
+    person = source.occ_w * source.occ_h
+    assert max(blanked) > 0, "the person was never blanked out"
+    # 影の跡が残って広がっていくなら人の大きさを超える
+    assert max(blanked[:leave_at]) <= 2 * person, \
+        "blanked area grew to {} px for a {} px person".format(max(blanked[:leave_at]), person)
+    assert not any(blanked[leave_at + settle_frames:]), \
+        "overlay still blanks {} px {} frames after the person left".format(
+            max(blanked[leave_at + settle_frames:]), settle_frames)
+    return blanked
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description="shadow compensation pipeline latency check")
+    parser.add_argument("--video", default=None, help="camera video file (default: synthetic frames)")
+    parser.add_argument("--reference", default=None, help="camera image of the unoccluded board")
+    parser.add_argument("--homography", default=None, help="3x3 camera->projector homography (.npy)")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--fps", type=float, default=60.0, help="frame rate of the synthetic camera")
+    parser.add_argument("--size", default="1920x1080", help="camera/projector resolution WxH")
+    args = parser.parse_args()
+
+    width, height = map(int, args.size.lower().split("x"))
+    if args.reference:
+        reference = cv2.imread(args.reference)
+        if reference is None:
+            raise IOError("cannot read reference image: {}".format(args.reference))
+    else:
+        reference = make_test_pattern(width, height)
+
+    if args.video:
+        source = VideoFileSource(args.video)
+    else:
+        source = SyntheticSource(reference, args.frames, fps=args.fps)
+
+    H = np.load(args.homography) if args.homography else np.eye(3)
+    compensator = ShadowCompensator(reference, (width, height), HomographyCache(H))
+    summary, n, dropped, elapsed = measure_latency(source, compensator)
+
+    print("frames: {}  dropped: {}  throughput: {:.1f} FPS".format(
+        n, dropped, n / elapsed if elapsed > 0 else 0.0))
+    if not n:
+        sys.exit(1)
+    print("latency mean {mean_ms:.2f} ms / p95 {p95_ms:.2f} ms / max {max_ms:.2f} ms".format(**summary))
+    print("over budget ({:.2f} ms): {} frames".format(FRAME_BUDGET * 1e3, summary["over_budget"]))
+    if summary["p95_ms"] > FRAME_BUDGET * 1e3:
+        print("FAIL: p95 latency is over the frame budget", file=sys.stderr)
+        sys.exit(1)
+
+    if not args.video:
+        # オーバーレイをカメラに写し返しても、マスクが広がったり残ったりしないこと
+        try:
+            blanked = check_overlay_feedback()
+        except AssertionError as e:
+            print("FAIL: {}".format(e), file=sys.stderr)
+            sys.exit(1)
+        print("feedback: max blanked {} px, cleared after the person left".format(max(blanked)))
@@ -0,0 +1,421 @@
+"""
+多数の画像（スプライト）をまとめて描画するレイヤ
+
+各スプライトの 位置 / 拡大率 / 回転 / UV / 不透明度 / テクスチャ を NumPy 配列で持ち、
+変更のあったスプライトの頂点だけを1つの動的頂点バッファ（VBO）に書き込む。
+描画はテクスチャごとに並べたインデックスで glDrawElements を呼ぶだけなので、
+テクスチャが1枚なら何枚重ねても描画呼び出しは1回になる。
+（同じテクスチャ内では追加順に重なり、テクスチャどうしはそのテクスチャを最初に使った順に重なる）
+
+マウスでの選択は一様グリッドの空間インデックスで候補を絞ってから判定する。
+
+Usage:
+------
+    python sprite_layer.py [--gl]    # 10 - 50,000 枚でのベンチマーク（--gl で VBO への転送と描画も計測）
+"""
+
+import math
+import ctypes
+import time
+
+from startup import lazy_import
+
+np = lazy_import("numpy")
+gl = lazy_import("pyglet.gl")
+
+#===============================
+# 定数
+#===============================
+INITIAL_CAPACITY = 64
+GRID_CELL = 128           # 空間インデックスのセルの大きさ [px]
+FLOATS_PER_VERTEX = 8     # x, y, u, v, r, g, b, a
+VERTEX_STRIDE = FLOATS_PER_VERTEX * 4
+
+# スプライト中心からの四隅（左下から反時計回り）
+CORNERS_X = (-0.5, 0.5, 0.5, -0.5)
+CORNERS_Y = (-0.5, -0.5, 0.5, 0.5)
+
+#===============================
+# 空間インデックス
+#===============================
+class SpatialGrid:
+    """uniform grid mapping cells to the sprites whose bounding box overlaps them"""
+
+    def __init__(self, cell=GRID_CELL):
+        self.cell = cell
+        self.cells = {}     # (cx, cy) -> set(スプライト番号)
+        self.ranges = {}    # スプライト番号 -> (cx0, cy0, cx1, cy1)
+
+    def update(self, indices, x0, y0, x1, y1):
+        c = float(self.cell)
+        cx0 = np.floor(x0 / c).astype(np.int64)
+        cy0 = np.floor(y0 / c).astype(np.int64)
+        cx1 = np.floor(x1 / c).astype(np.int64)
+        cy1 = np.floor(y1 / c).astype(np.int64)
+        for i, r in zip(indices.tolist(), zip(cx0.tolist(), cy0.tolist(), cx1.tolist(), cy1.tolist())):
+            old = self.ranges.get(i)
+            if old == r:
+                continue
+            if old is not None:
+                self._remove(i, old)
+            self.ranges[i] = r
+            for cx in range(r[0], r[2] + 1):
+                for cy in range(r[1], r[3] + 1):
+                    self.cells.setdefault((cx, cy), set()).add(i)
+
+    def _remove(self, i, r):
+        for cx in range(r[0], r[2] + 1):
+            for cy in range(r[1], r[3] + 1):
+                bucket = self.cells.get((cx, cy))
+                if bucket is not None:
+                    bucket.discard(i)
+                    if not bucket:
+                        del self.cells[(cx, cy)]
+
+    def query(self, x, y):
+        c = float(self.cell)
+        return self.cells.get((int(math.floor(x / c)), int(math.floor(y / c))), ())
+
+#===============================
+# スプライトレイヤ
+#===============================
+class SpriteLayer:
+    def __init__(self, capacity=INITIAL_CAPACITY, cell=GRID_CELL):
+        self.count = 0
+        self._allocate(capacity)
+        self.grid = SpatialGrid(cell)
+
+        self._order = np.zeros(0, dtype=np.int64)   # 描画順（テクスチャごとにまとめた並び）
+        self._rank = np.zeros(0, dtype=np.int64)    # スプライト番号 -> 描画順での位置
+        self._groups = []                           # [(テクスチャ, 開始位置, 枚数)]
+        self._order_dirty = False
+
+        # GL のバッファ（最初の描画時に作る）
+        self._vbo = None
+        self._ibo = None
+        self._gpu_capacity = 0
+        self._indices_dirty = False
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self.position = np.zeros((capacity, 2), dtype=np.float32)   # 左下の位置 [px]（回転前）
+        self.size = np.zeros((capacity, 2), dtype=np.float32)       # 元の幅・高さ [px]
+        self.scale = np.ones((capacity, 2), dtype=np.float32)
+        self.rotation = np.zeros(capacity, dtype=np.float32)        # 中心まわりの回転 [rad]
+        self.uv = np.zeros((capacity, 4), dtype=np.float32)         # u0, v0, u1, v1
+        self.opacity = np.ones(capacity, dtype=np.float32)
+        self.texture = np.zeros(capacity, dtype=np.int64)           # GL のテクスチャ ID
+        self.vertices = np.zeros((capacity, 4, FLOATS_PER_VERTEX), dtype=np.float32)
+        self.dirty = np.zeros(capacity, dtype=bool)            # 頂点の再計算が必要（CPU 側）
+        self.upload_pending = np.zeros(capacity, dtype=bool)   # 再計算済みで VBO への転送待ち
+
+    def _grow(self, needed):
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        n = self.count
+        old = (self.position, self.size, self.scale, self.rotation, self.uv,
+               self.opacity, self.texture, self.vertices, self.dirty, self.upload_pending)
+        self._allocate(capacity)
+        new = (self.position, self.size, self.scale, self.rotation, self.uv,
+               self.opacity, self.texture, self.vertices, self.dirty, self.upload_pending)
+        for dst, src in zip(new, old):
+            dst[:n] = src[:n]
+
+    #-------------------------------
+    # スプライトの追加・変更
+    #-------------------------------
+    def add_many(self, texture, x, y, width, height, scale=1.0, rotation=0.0, uv=(0.0, 0.0, 1.0, 1.0), opacity=1.0):
+        """add sprites (arguments broadcast against each other); returns their indices"""
+        x, y, width, height, scale, rotation, opacity, texture = np.broadcast_arrays(
+            np.asarray(x, np.float32), np.asarray(y, np.float32),
+            np.asarray(width, np.float32), np.asarray(height, np.float32),
+            np.asarray(scale, np.float32), np.asarray(rotation, np.float32),
+            np.asarray(opacity, np.float32), np.asarray(texture, np.int64))
+        n = x.size
+        start = self.count
+        if start + n > self.capacity:
+            self._grow(start + n)
+        s = slice(start, start + n)
+
+        self.position[s, 0] = x.ravel()
+        self.position[s, 1] = y.ravel()
+        self.size[s, 0] = width.ravel()
+        self.size[s, 1] = height.ravel()
+        self.scale[s] = scale.ravel()[:, None]
+        self.rotation[s] = rotation.ravel()
+        self.uv[s] = np.asarray(uv, np.float32)
+        self.opacity[s] = opacity.ravel()
+        self.texture[s] = texture.ravel()
+        self.dirty[s] = True
+
+        self.count += n
+        self._order_dirty = True
+        return np.arange(start, start + n)
+
+    def add(self, texture, x, y, width, height, **kwargs):
+        return int(self.add_many(texture, x, y, width, height, **kwargs)[0])
+
+    def move(self, i, dx, dy):
+        self.position[i] += (dx, dy)
+        self.dirty[i] = True
+
+    def set(self, i, x=None, y=None, scale=None, rotation=None, uv=None, opacity=None, texture=None):
+        if x is not None:
+            self.position[i, 0] = x
+        if y is not None:
+            self.position[i, 1] = y
+        if scale is not None:
+            self.scale[i] = scale
+        if rotation is not None:
+            self.rotation[i] = rotation
+        if uv is not None:
+            self.uv[i] = uv
+        if opacity is not None:
+            self.opacity[i] = opacity
+        if texture is not None:
+            self.texture[i] = texture
+            self._order_dirty = True
+        self.dirty[i] = True
+
+    #-------------------------------
+    # 頂点データの更新（CPU 側）
+    #-------------------------------
+    def _geometry(self, idx):
+        w = self.size[idx, 0] * self.scale[idx, 0]
+        h = self.size[idx, 1] * self.scale[idx, 1]
+        cx = self.position[idx, 0] + w * 0.5
+        cy = self.position[idx, 1] + h * 0.5
+        return w, h, cx, cy, np.cos(self.rotation[idx]), np.sin(self.rotation[idx])
+
+    def update_vertices(self):
+        """recompute the vertices of changed sprites; returns their indices"""
+        idx = np.flatnonzero(self.dirty[:self.count])
+        if idx.size == 0:
+            return idx
+
+        w, h, cx, cy, c, s = self._geometry(idx)
+        lx = np.asarray(CORNERS_X, np.float32)[None, :] * w[:, None]
+        ly = np.asarray(CORNERS_Y, np.float32)[None, :] * h[:, None]
+        v = self.vertices[idx]
+        v[..., 0] = cx[:, None] + lx * c[:, None] - ly * s[:, None]
+        v[..., 1] = cy[:, None] + lx * s[:, None] + ly * c[:, None]
+
+        uv = self.uv[idx]
+        v[..., 2] = uv[:, (0, 2, 2, 0)]
+        v[..., 3] = uv[:, (1, 1, 3, 3)]
+        v[..., 4:7] = 1.0
+        v[..., 7] = self.opacity[idx][:, None]
+        self.vertices[idx] = v
+
+        # 回転後の外接矩形で空間インデックスを更新する
+        ex = (np.abs(w * c) + np.abs(h * s)) * 0.5
+        ey = (np.abs(w * s) + np.abs(h * c)) * 0.5
+        self.grid.update(idx, cx - ex, cy - ey, cx + ex, cy + ey)
+
+        self.dirty[idx] = False
+        # hit_test() から呼ばれても転送漏れがないよう、転送待ちは upload() でだけ消す
+        self.upload_pending[idx] = True
+        return idx
+
+    def update_order(self):
+        """group the sprites by texture, keeping insertion order within each group"""
+        if not self._order_dirty:
+            return
+        textures = self.texture[:self.count]
+        values, first, inverse = np.unique(textures, return_index=True, return_inverse=True)
+        # テクスチャの並びは、そのテクスチャが最初に現れた順
+        by_first = np.argsort(first)
+        group_rank = np.empty_like(by_first)
+        group_rank[by_first] = np.arange(values.size)
+        key = group_rank[inverse.ravel()]
+
+        self._order = np.argsort(key, kind="stable")
+        self._rank = np.empty_like(self._order)
+        self._rank[self._order] = np.arange(self.count)
+
+        counts = np.bincount(key, minlength=values.size)
+        starts = np.cumsum(counts) - counts
+        self._groups = [(int(values[by_first[g]]), int(starts[g]), int(counts[g])) for g in range(values.size)]
+        self._order_dirty = False
+        self._indices_dirty = True
+
+    def hit_test(self, x, y):
+        """index of the topmost sprite containing (x, y), or -1"""
+        self.update_vertices()
+        self.update_order()
+        candidates = np.fromiter(self.grid.query(x, y), dtype=np.int64)
+        if candidates.size == 0:
+            return -1
+
+        w, h, cx, cy, c, s = self._geometry(candidates)
+        dx = x - cx
+        dy = y - cy
+        # スプライトのローカル座標に戻して矩形の内外を判定する
+        lx = dx * c + dy * s
+        ly = -dx * s + dy * c
+        inside = (np.abs(lx) <= w * 0.5) & (np.abs(ly) <= h * 0.5)
+        hits = candidates[inside]
+        if hits.size == 0:
+            return -1
+        return int(hits[np.argmax(self._rank[hits])])
+
+    #-------------------------------
+    # GL への転送と描画
+    #-------------------------------
+    def _upload_runs(self, idx):
+        # 連続した番号ごとにまとめて glBufferSubData で転送する
+        breaks = np.flatnonzero(np.diff(idx) != 1) + 1
+        for run in np.split(idx, breaks):
+            start, end = int(run[0]), int(run[-1]) + 1
+            nbytes = (end - start) * 4 * VERTEX_STRIDE
+            gl.glBufferSubData(gl.GL_ARRAY_BUFFER, start * 4 * VERTEX_STRIDE, nbytes,
+                               self.vertices[start:end].ctypes.data_as(ctypes.c_void_p))
+
+    def upload(self):
+        self.update_vertices()
+        self.update_order()
+        changed = np.flatnonzero(self.upload_pending[:self.count])
+
+        if self._vbo is None:
+            self._vbo = gl.GLuint(0)
+            self._ibo = gl.GLuint(0)
+            gl.glGenBuffers(1, ctypes.byref(self._vbo))
+            gl.glGenBuffers(1, ctypes.byref(self._ibo))
+
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self._vbo)
+        if self._gpu_capacity != self.capacity:
+            # 容量が変わったときはバッファを作り直して全体を転送する
+            gl.glBufferData(gl.GL_ARRAY_BUFFER, self.vertices.nbytes,
+                            self.vertices.ctypes.data_as(ctypes.c_void_p), gl.GL_DYNAMIC_DRAW)
+            self._gpu_capacity = self.capacity
+        elif changed.size:
+            self._upload_runs(changed)
+        self.upload_pending[:self.count] = False
+
+        if self._indices_dirty:
+            indices = (self._order[:, None] * 4 + np.arange(4)[None, :]).astype(np.uint32).ravel()
+            gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self._ibo)
+            gl.glBufferData(gl.GL_ELEMENT_ARRAY_BUFFER, indices.nbytes,
+                            indices.ctypes.data_as(ctypes.c_void_p), gl.GL_DYNAMIC_DRAW)
+            self._indices_dirty = False
+
+    def draw(self):
+        if self.count == 0:
+            return
+        self.upload()
+
+        gl.glEnable(gl.GL_TEXTURE_2D)
+        gl.glEnable(gl.GL_BLEND)
+        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+        gl.glTexEnvi(gl.GL_TEXTURE_ENV, gl.GL_TEXTURE_ENV_MODE, gl.GL_MODULATE)
+
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self._vbo)
+        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self._ibo)
+        gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glEnableClientState(gl.GL_TEXTURE_COORD_ARRAY)
+        gl.glEnableClientState(gl.GL_COLOR_ARRAY)
+        gl.glVertexPointer(2, gl.GL_FLOAT, VERTEX_STRIDE, ctypes.c_void_p(0))
+        gl.glTexCoordPointer(2, gl.GL_FLOAT, VERTEX_STRIDE, ctypes.c_void_p(2 * 4))
+        gl.glColorPointer(4, gl.GL_FLOAT, VERTEX_STRIDE, ctypes.c_void_p(4 * 4))
+
+        for texture, start, count in self._groups:
+            gl.glBindTexture(gl.GL_TEXTURE_2D, texture)
+            gl.glDrawElements(gl.GL_QUADS, count * 4, gl.GL_UNSIGNED_INT, ctypes.c_void_p(start * 4 * 4))
+
+        gl.glDisableClientState(gl.GL_COLOR_ARRAY)
+        gl.glDisableClientState(gl.GL_TEXTURE_COORD_ARRAY)
+        gl.glDisableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, 0)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+        gl.glDisable(gl.GL_BLEND)
+        gl.glDisable(gl.GL_TEXTURE_2D)
+
+#===============================
+# ベンチマーク
+#===============================
+def _time(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+def benchmark(counts=(10, 100, 1000, 10000, 50000), n_textures=4, moved=0.01, with_gl=False, repeat=20):
+    rng = np.random.default_rng(0)
+    width, height = 1920, 1080
+
+    window = None
+    textures = list(range(1, n_textures + 1))
+    if with_gl:
+        import pyglet
+        window = pyglet.window.Window(width, height, visible=False)
+        ids = (gl.GLuint * n_textures)()
+        gl.glGenTextures(n_textures, ids)
+        white = (gl.GLubyte * 4)(255, 255, 255, 255)
+        for tex in ids:
+            gl.glBindTexture(gl.GL_TEXTURE_2D, tex)
+            gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, 1, 1, 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, white)
+        textures = list(ids)
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glLoadIdentity()
+        gl.glOrtho(0, width, 0, height, -1, 1)
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+        gl.glLoadIdentity()
+
+    columns = ["sprites", "build [ms]", "hit [us]", "cpu [ms]"]
+    if with_gl:
+        columns += ["upload [ms]", "draw [ms]", "frame [ms]"]
+    print(" ".join("{:>12s}".format(c) for c in columns))
+    for n in counts:
+        layer = SpriteLayer()
+        start = time.perf_counter()
+        layer.add_many(rng.choice(textures, n), rng.uniform(0, width, n), rng.uniform(0, height, n),
+                       64, 64, rotation=rng.uniform(0, 2 * np.pi, n))
+        layer.update_vertices()
+        layer.update_order()
+        t_build = time.perf_counter() - start
+
+        points = rng.uniform((0, 0), (width, height), (repeat, 2))
+        t_hit = _time(lambda: layer.hit_test(*points[rng.integers(repeat)]), repeat)
+
+        if with_gl:
+            layer.draw()   # 最初の全体転送は除く
+            gl.glFinish()
+
+        # 1フレーム = 一部のスプライトを動かす -> 頂点の再計算 -> 変更分だけ転送 -> 描画
+        n_moved = max(1, int(n * moved))
+        t_cpu = t_upload = t_draw = 0.0
+        for _ in range(repeat):
+            moved_idx = rng.integers(0, n, n_moved)
+            t0 = time.perf_counter()
+            layer.move(moved_idx, 1.0, 0.0)
+            layer.update_vertices()
+            t1 = time.perf_counter()
+            t_cpu += t1 - t0
+            if with_gl:
+                layer.upload()
+                gl.glFinish()
+                t2 = time.perf_counter()
+                layer.draw()
+                gl.glFinish()
+                t3 = time.perf_counter()
+                t_upload += t2 - t1
+                t_draw += t3 - t2
+
+        row = [n, t_build * 1e3, t_hit * 1e6, t_cpu / repeat * 1e3]
+        if with_gl:
+            row += [t_upload / repeat * 1e3, t_draw / repeat * 1e3, (t_cpu + t_upload + t_draw) / repeat * 1e3]
+        print("{:12d} {:12.2f} {:12.1f} ".format(*row[:3]) + " ".join("{:12.3f}".format(v) for v in row[3:]))
+
+    if window is not None:
+        window.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="sprite layer benchmark")
+    parser.add_argument("--gl", action="store_true", help="also measure upload and drawing (needs a display)")
+    parser.add_argument("--moved", type=float, default=0.01, help="fraction of sprites moved per frame")
+    args = parser.parse_args()
+    benchmark(moved=args.moved, with_gl=args.gl)
@@ -0,0 +1,108 @@
+"""
+起動時間短縮のための補助モジュール
+
+- lazy_import(name) : 重いモジュール（cv2, PIL, numpy, pyglet）を初回アクセス時に読み込む
+- PROFILER          : import / 初期化の各段階の所要時間を記録し、--profile-startup で表示する
+
+このモジュール自体は標準ライブラリしか import しない。
+"""
+
+import importlib
+import sys
+import threading
+import time
+
+#===============================
+# 起動時間の計測
+#===============================
+class StartupProfiler:
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.enabled = False
+        self.imports = []    # (モジュール名, 所要時間 [s])
+        self.marks = []      # (ラベル, 起動からの経過時間 [s])
+        self._last = self.t0
+        self._lock = threading.Lock()
+        self._reported = False
+
+    def record_import(self, name, elapsed):
+        with self._lock:
+            self.imports.append((name, elapsed))
+
+    def mark(self, label):
+        """record the elapsed time since startup under the given label"""
+        now = time.perf_counter()
+        with self._lock:
+            self.marks.append((label, now - self.t0, now - self._last))
+            self._last = now
+
+    def frame_drawn(self):
+        """call after each on_draw; reports the breakdown after the first frame"""
+        if self.enabled and not self._reported:
+            self.mark("first frame")
+            self.report()
+
+    def report(self, out=None):
+        """print the import/initialization breakdown once"""
+        if not self.enabled or self._reported:
+            return
+        self._reported = True
+        out = out or sys.stderr
+
+        print("---- startup profile ----", file=out)
+        print("[import]", file=out)
+        for name, elapsed in self.imports:
+            print("  {:<24s} {:8.1f} ms".format(name, elapsed * 1e3), file=out)
+        print("[init]", file=out)
+        for label, total, delta in self.marks:
+            print("  {:<24s} {:8.1f} ms  (+{:.1f} ms)".format(label, total * 1e3, delta * 1e3), file=out)
+        print("-------------------------", file=out)
+
+
+PROFILER = StartupProfiler()
+
+#===============================
+# 遅延 import
+#===============================
+class LazyModule:
+    """module proxy that imports the real module on first attribute access"""
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                start = time.perf_counter()
+                module = importlib.import_module(self._name)
+                PROFILER.record_import(self._name, time.perf_counter() - start)
+                self.__dict__["_module"] = module
+        return self._module
+
+    def __getattr__(self, attr):
+        value = getattr(self._module or self._load(), attr)
+        # 2回目以降は通常の属性参照で済むようにキャッシュする
+        self.__dict__[attr] = value
+        return value
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return "<lazy module '{}' ({})>".format(self._name, state)
+
+
+def lazy_import(name):
+    # すでに読み込み済みならそのまま返す
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+def add_profile_option(argv=None):
+    """enable PROFILER if --profile-startup is given, and return the remaining args"""
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if "--profile-startup" in argv:
+        argv.remove("--profile-startup")
+        PROFILER.enabled = True
+    return argv